@@ -8,9 +8,10 @@ This code is written by Vuong Pham and Tuong Do.
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 class MILQT(nn.Module):
-    def __init__(self, qt_model, models, question_type_mapping, combination_operator='add'):
+    def __init__(self, qt_model, models, question_type_mapping, combination_operator='add', use_checkpoint=False):
         super(MILQT, self).__init__()
         self.question_type_model = qt_model
 
@@ -18,6 +19,7 @@ class MILQT(nn.Module):
         self.models = nn.ModuleList(model for model in models)
         self.num_models = len(models)
         self.combination_operator = combination_operator
+        self.use_checkpoint = use_checkpoint
         self.pred_combining_layer = nn.Linear(self.num_models, 1, bias=False)
         self.question_type_mapping = question_type_mapping
         self.features = [0]*self.num_models
@@ -29,8 +31,13 @@ class MILQT(nn.Module):
         # Do forward pass of every model
         question_emb = self.question_type_model(questions)  # b x 1024
 
+        # Recompute the attention activations of every model in backward pass to save memory
+        use_checkpoint = self.use_checkpoint and self.training and torch.is_grad_enabled()
         for idx, model in enumerate(self.models):
-            self.features[idx] = model(visuals, boxes, questions)
+            if use_checkpoint:
+                self.features[idx] = checkpoint(model, visuals, boxes, questions, use_reentrant=False)
+            else:
+                self.features[idx] = model(visuals, boxes, questions)
 
         question_type_preds = self.question_type_model.classify(question_emb)
         for idx, model in enumerate(self.models):
@@ -201,4 +201,5 @@ def build_MILQT(dataset, args):
         binary_mapping[question_type_mapping[i]][i] = 1
 
     # Return a MILQT model
-    return MILQT(question_type_model, models, binary_mapping, args.combination_operator)
+    return MILQT(question_type_model, models, binary_mapping, args.combination_operator,
+                 use_checkpoint=getattr(args, 'activation_checkpoint', False))
@@ -75,6 +75,12 @@ def parse_args():
                         help='specify index of GPU using for training, to use CPU: -1')
     parser.add_argument('--clip_norm', default=.25, type=float, metavar='NORM',
                         help='clip threshold of gradients')
+    parser.add_argument('--amp', action='store_true', default=False,
+                        help='use automatic mixed precision training')
+    parser.add_argument('--activation_checkpoint', action='store_true', default=False,
+                        help='use activation checkpointing on interaction learning components to save memory')
+    parser.add_argument('--preload_features', action='store_true', default=False,
+                        help='keep image features on GPU memory, only for features that fit in it')
     parser.add_argument('--weight_init', type=str, default='none', choices=['none', 'kaiming_normal'],
                         help='dynamic weighting with Kaiming normalization')
 
@@ -153,6 +159,12 @@ if __name__ == '__main__':
         train_dset = VQAFeatureDataset('train', args, dictionary, adaptive=True, max_boxes=args.max_boxes, question_len=args.question_len)
         val_dset = VQAFeatureDataset('val', args, dictionary, adaptive=True, max_boxes=args.max_boxes, question_len=args.question_len)
 
+    # Keep image features resident on device so that batches need no host-to-device copy of them
+    if args.preload_features:
+        for dset in [train_dset, val_dset]:
+            dset.features = dset.features.to(device)
+            dset.spatials = dset.spatials.to(device)
+
     batch_size = args.batch_size
 
     constructor = 'build_%s' % args.model
@@ -161,6 +173,7 @@ if __name__ == '__main__':
     # Comment because do not use multi gpu
     # model = nn.DataParallel(model)
     optim = None
+    scaler_state = None
     epoch = 0
     # load snapshot
     if args.input is not None:
@@ -168,8 +181,10 @@ if __name__ == '__main__':
         model_data = torch.load(args.input)
         model.load_state_dict(model_data.get('model_state', model_data))
         model.to(device)
-        optim = torch.optim.Adamax(filter(lambda p: p.requires_grad, model.parameters()))
+        params = [p for p in model.parameters() if p.requires_grad]
+        optim = torch.optim.Adamax(params, foreach=True)
         optim.load_state_dict(model_data.get('optimizer_state', model_data))
+        scaler_state = model_data.get('scaler_state')
         epoch = model_data['epoch'] + 1
 
     if args.use_both: # use train & val splits to optimize
@@ -181,7 +196,7 @@ if __name__ == '__main__':
             trainval_dset = ConcatDataset([train_dset, val_dset]+vg_dsets)
         else:
             trainval_dset = ConcatDataset([train_dset, val_dset])
-        train_loader = DataLoader(trainval_dset, batch_size, shuffle=True, num_workers=0, collate_fn=utils.trim_collate, pin_memory=True)
+        train_loader = DataLoader(trainval_dset, batch_size, shuffle=True, num_workers=0, collate_fn=utils.trim_collate, pin_memory=not args.preload_features)
         eval_loader = None
     else:
         if args.use_vg:
@@ -191,7 +206,7 @@ if __name__ == '__main__':
             ]
             train_dset = train_dset + vg_dsets[0]
             val_dset = val_dset + vg_dsets[1]
-        train_loader = DataLoader(train_dset, batch_size, shuffle=True, num_workers=0, collate_fn=utils.trim_collate, pin_memory=True)
-        eval_loader = DataLoader(val_dset, batch_size, shuffle=False, num_workers=0, collate_fn=utils.trim_collate, pin_memory=False)
+        train_loader = DataLoader(train_dset, batch_size, shuffle=True, num_workers=0, collate_fn=utils.trim_collate, pin_memory=not args.preload_features)
+        eval_loader = DataLoader(val_dset, batch_size, shuffle=False, num_workers=0, collate_fn=utils.trim_collate, pin_memory=not args.preload_features)
 
-    train(args, model, train_loader, eval_loader, args.epochs, args.output, optim, epoch)
+    train(args, model, train_loader, eval_loader, args.epochs, args.output, optim, epoch, scaler_state)
@@ -11,21 +11,19 @@ from trainer import Trainer
 warmup_updates = 4000
 
 # Kaiming normalization initialization
-def init_weights(m):
-    if type(m) == nn.Linear:
-        with torch.no_grad():
-            torch.nn.init.kaiming_normal_(m.weight)
+def init_weights(model):
+    with torch.no_grad():
+        for m in model.modules():
+            if type(m) == nn.Linear:
+                torch.nn.init.kaiming_normal_(m.weight)
 
 # VQA score computation
 def compute_score_with_logits(logits, labels):
-    logits = torch.max(logits, 1)[1].data # argmax
-    one_hots = torch.zeros(*labels.size()).to(logits.device)
-    one_hots.scatter_(1, logits.view(-1, 1), 1)
-    scores = (one_hots * labels)
-    return scores
+    idx = logits.detach().argmax(1, keepdim=True)  # argmax
+    return labels.gather(1, idx).squeeze(1)  # score of the predicted answer per sample
 
 # Train phase
-def train(args, model, train_loader, eval_loader, num_epochs, output, opt=None, s_epoch=0):
+def train(args, model, train_loader, eval_loader, num_epochs, output, opt=None, s_epoch=0, scaler_state=None):
     device = args.device
     # Scheduler learning rate
     lr_default = args.lr
@@ -39,8 +37,8 @@ def train(args, model, train_loader, eval_loader, num_epochs, output, opt=None,
     utils.create_dir(output)
 
     # Adamax optimizer
-    optim = torch.optim.Adamax(filter(lambda p: p.requires_grad, model.parameters()), lr=lr_default) \
-        if opt is None else opt
+    params = [p for p in model.parameters() if p.requires_grad]
+    optim = torch.optim.Adamax(params, lr=lr_default, foreach=True) if opt is None else opt
     criterion = torch.nn.BCEWithLogitsLoss(reduction='sum')
     logger = utils.Logger(os.path.join(output, 'log.txt'))
     logger.write(args.__repr__())
@@ -48,22 +46,27 @@ def train(args, model, train_loader, eval_loader, num_epochs, output, opt=None,
 
     # Kaiming normalization for initialization
     if args.weight_init == "kaiming_normal":
-        model.apply(init_weights)
+        init_weights(model)
 
     utils.print_model(model, logger)
     logger.write('optim: adamax lr=%.4f, decay_step=%d, decay_rate=%.2f, grad_clip=%.2f' % \
         (lr_default, lr_decay_step, lr_decay_rate, grad_clip))
 
     trainer = Trainer(args, model, criterion, optim)
+    # Resume the loss scale of a mixed precision run
+    if scaler_state is not None and trainer.scaler.is_enabled():
+        trainer.scaler.load_state_dict(scaler_state)
     update_freq = int(args.update_freq)
+    log_every = int(args.print_interval / update_freq)
     wall_time_start = time.time()
 
     # Epoch passing in training phase
     for epoch in range(s_epoch, num_epochs):
-        total_loss = 0
-        train_score = 0
-        train_question_type_score = 0
-        total_norm = 0
+        # loss, norm and scores are accumulated on device and only read back when logging
+        total_loss = torch.zeros((), device=device)
+        train_score = torch.zeros((), device=device)
+        train_question_type_score = torch.zeros((), device=device)
+        total_norm = torch.zeros((), device=device)
         count_norm = 0
         num_updates = 0
         t = time.time()
@@ -79,33 +82,30 @@ def train(args, model, train_loader, eval_loader, num_epochs, output, opt=None,
             logger.write('lr: %.4f' % trainer.optimizer.param_groups[0]['lr'])
 
         # Predicting and computing score
-        for i, (v, b, q, a, qt) in enumerate(train_loader):
-            v = v.to(device)
-            b = b.to(device)
-            q = q.to(device)
-            a = a.to(device)
-            qt = qt.to(device)
+        for i, (v, b, q, a, qt) in enumerate(utils.DataPrefetcher(train_loader, device)):
             sample = [v, b, q, a, qt]
 
             if i < num_batches - 1 and (i + 1) % update_freq > 0:
                 trainer.train_step(sample, update_params=False)
             else:
                 loss, grad_norm, batch_score, batch_question_type_score = trainer.train_step(sample, update_params=True)
-                total_norm += grad_norm
-                count_norm += 1
+                if grad_norm is not None:  # None when the update was skipped on overflow
+                    total_norm += grad_norm
+                    count_norm += 1
 
-                total_loss += loss.item()
-                train_score += batch_score
-                train_question_type_score += batch_question_type_score
+                total_loss += loss.detach()
+                train_score.add_(batch_score)
+                train_question_type_score.add_(batch_question_type_score)
                 num_updates += 1
-                if num_updates % int(args.print_interval / update_freq) == 0:
-                    print("Iter: {}, Loss {:.4f}, Norm: {:.4f}, Total norm: {:.4f}, Num updates: {}, Wall time: {:.2f}, ETA: {}".format(i + 1, total_loss / ((num_updates + 1)), grad_norm, total_norm, num_updates, time.time() - wall_time_start, utils.time_since(t, i / num_batches)))
+                if num_updates % log_every == 0:
+                    print("Iter: {}, Loss {:.4f}, Norm: {:.4f}, Total norm: {:.4f}, Num updates: {}, Wall time: {:.2f}, ETA: {}".format(i + 1, total_loss.item() / ((num_updates + 1)), utils.item(grad_norm) if grad_norm is not None else float('nan'), total_norm.item(), num_updates, time.time() - wall_time_start, utils.time_since(t, i / num_batches)))
                     if args.testing:
                         break
 
-        total_loss /= num_updates
-        train_score = 100 * train_score / (num_updates * args.batch_size)
-        train_question_type_score = 100 * train_question_type_score / (num_updates * args.batch_size)
+        total_loss = total_loss.item() / num_updates
+        total_norm = total_norm.item()
+        train_score = 100 * train_score.item() / (num_updates * args.batch_size)
+        train_question_type_score = 100 * train_question_type_score.item() / (num_updates * args.batch_size)
 
         # Evaluation
         if eval_loader is not None:
@@ -123,44 +123,46 @@ def train(args, model, train_loader, eval_loader, num_epochs, output, opt=None,
         # Save per epoch
         if epoch >= saving_epoch:
             model_path = os.path.join(output, 'model_epoch%d.pth' % epoch)
-            utils.save_model(model_path, model, epoch, trainer.optimizer)
+            utils.save_model(model_path, model, epoch, trainer.optimizer, trainer.scaler)
             # Save best epoch
             if eval_loader is not None and eval_score > best_eval_score:
                 model_path = os.path.join(output, 'model_epoch_best.pth')
-                utils.save_model(model_path, model, epoch, trainer.optimizer)
+                utils.save_model(model_path, model, epoch, trainer.optimizer, trainer.scaler)
                 best_eval_score = eval_score
 
 # Evaluation
 def evaluate(model, dataloader, args):
     device = args.device
-    score = 0
-    question_type_score = 0
-    upper_bound = 0
-    question_type_upper_bound = 0
+    # keep running sums on device so that the loop never syncs with the host
+    score = torch.zeros((), device=device)
+    question_type_score = torch.zeros((), device=device)
+    upper_bound = torch.zeros((), device=device)
+    question_type_upper_bound = torch.zeros((), device=device)
     num_data = 0
-    with torch.no_grad():
+    with torch.inference_mode():
         for v, b, q, a, qt in iter(dataloader):
-            v = v.to(device)
-            b = b.to(device)
-            q = q.to(device)
-            qt = qt.to(device)
+            v = v.to(device, non_blocking=True)
+            b = b.to(device, non_blocking=True)
+            q = q.to(device, non_blocking=True)
+            a = a.to(device, non_blocking=True)
+            qt = qt.to(device, non_blocking=True)
             final_preds = None
             if args.model == "MILQT":
                 _, _, combined_preds, question_type_preds, _ = model(v, b, q)   #MILQT answer and question type prediction
                 final_preds = combined_preds
             # MILQT answer classification score computation
-            batch_score = compute_score_with_logits(final_preds, a.to(device)).sum()
+            batch_score = compute_score_with_logits(final_preds, a).sum()
             score += batch_score
             # MILQT question-type classification score computation
             question_type_batch_score = compute_score_with_logits(question_type_preds, qt).sum()
             question_type_score += question_type_batch_score
-            upper_bound += (a.max(1)[0]).sum()
-            question_type_upper_bound += (qt.max(1)[0]).sum()
+            upper_bound += torch.amax(a, 1).sum()
+            question_type_upper_bound += torch.amax(qt, 1).sum()
             num_data += final_preds.size(0)
 
-    score = score / len(dataloader.dataset)
-    upper_bound = upper_bound / len(dataloader.dataset)
-    question_type_score /= len(dataloader.dataset)
-    question_type_upper_bound /= len(dataloader.dataset)
+    score = score.item() / len(dataloader.dataset)
+    upper_bound = upper_bound.item() / len(dataloader.dataset)
+    question_type_score = question_type_score.item() / len(dataloader.dataset)
+    question_type_upper_bound = question_type_upper_bound.item() / len(dataloader.dataset)
 
     return score, upper_bound, question_type_score, question_type_upper_bound
@@ -3,8 +3,8 @@ This code is modified from Jin-Hwa Kim, Jaehyun Jun, Byoung-Tak Zhang's reposito
 https://github.com/jnhwkim/ban-vqa
 """
 import torch
+import torch.nn.functional as F
 import utils
-import contextlib
 from collections import defaultdict, OrderedDict
 from meters import AverageMeter, TimeMeter
 
@@ -19,6 +19,9 @@ class Trainer(object):
         self.model = model.to(self.args.device)
         self.criterion = criterion.to(self.args.device)
 
+        # cache trainable parameters once instead of walking the model every update
+        self._trainable_params = [p for p in self.model.parameters() if p.requires_grad]
+
         # initialize meters
         self.meters = OrderedDict()
         self.meters['train_loss'] = AverageMeter()
@@ -35,13 +38,15 @@ class Trainer(object):
         self.meters['wall'] = TimeMeter()      # wall time in seconds
 
         self._buffered_stats = defaultdict(lambda: [])
-        self._flat_grads = None
         self._num_updates = 0
         self._optim_history = None
         self._optimizer = None
         if optimizer is not None:
             self._optimizer = optimizer
 
+        # loss scaler for mixed precision training, a no-op when amp is disabled
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.args.amp)
+
         self.total_loss = 0.0
         self.train_score = 0.0
         self.total_norm = 0.0
@@ -99,7 +104,7 @@ class Trainer(object):
                 # update meters
                 if grad_norm is not None:
                     self.meters['gnorm'].update(grad_norm)
-                    self.meters['clip'].update(1. if grad_norm > self.args.clip_norm else 0.)
+                    self.meters['clip'].update((grad_norm > self.args.clip_norm).float())
 
                 self.meters['oom'].update(ooms_fwd + ooms_bwd)
 
@@ -126,38 +131,14 @@ class Trainer(object):
         batch_question_type_score = None
         if sample is not None:
             try:
-                with torch.no_grad() if eval else contextlib.ExitStack():
-                    # calculate loss and sample size
-                    # sample[0] = v, sample[1] = b, sample[2] = q, sample[3] = a
-                    answers = sample[3]
-                    ans_type = sample[4]
-                    # MILQT loss computation
-                    if self.args.model == "MILQT":
-                        # predictions
-                        preds_combined, model_preds, model_preds_combined, question_type_preds, mask = self.model(sample[0], sample[1], sample[2])
-
-                        # question-type classification loss
-                        question_type_loss = self.criterion(question_type_preds.float(), ans_type)
-                        question_type_loss /= answers.size()[0]
-
-                        # component losses
-                        comp_losses = [self.criterion(pred.float(), answers)/answers.size()[0] for pred in preds_combined]
-
-                        # VQA loss with question-type awareness and prior integrating into interaction learning
-                        prior_weighting_loss = self.criterion(model_preds.float() * mask, answers * mask)
-                        prior_weighting_loss /= answers.size()[0]  # divided by batch size
-
-                        awareness_weighting_loss = self.criterion(model_preds_combined.float(), answers)
-                        awareness_weighting_loss /= answers.size()[0]  # divided by batch size
-
-                        # prior_awareness_vqa_loss = awareness_weighting_loss + self.args.g_ratio * prior_weighting_loss
-
-                        # VQA multi-task loss
-                        loss = sum(comp_losses) + awareness_weighting_loss + self.args.g_ratio * prior_weighting_loss + self.args.q_ratio * question_type_loss
-
-                        final_preds = model_preds_combined
-                        batch_question_type_score = compute_score_with_logits(question_type_preds, ans_type).sum()
-                    batch_score = compute_score_with_logits(final_preds, sample[3].data).sum()
+                if eval:
+                    with torch.no_grad():
+                        loss, batch_score, batch_question_type_score = self._compute_loss(sample)
+                elif self.args.amp:
+                    with torch.cuda.amp.autocast():
+                        loss, batch_score, batch_question_type_score = self._compute_loss(sample)
+                else:
+                    loss, batch_score, batch_question_type_score = self._compute_loss(sample)
             except RuntimeError as e:
                 if not eval and 'out of memory' in str(e):
                     print('| WARNING: ran out of memory, skipping batch')
@@ -167,12 +148,48 @@ class Trainer(object):
                     raise e
         return loss, len(sample[0]), oom, batch_score, batch_question_type_score  # TODO: Not sure about sample size, need to recheck
 
+    def _compute_loss(self, sample):
+        loss = None
+        batch_question_type_score = None
+        # calculate loss and sample size
+        # sample[0] = v, sample[1] = b, sample[2] = q, sample[3] = a
+        answers = sample[3]
+        ans_type = sample[4]
+        # MILQT loss computation
+        if self.args.model == "MILQT":
+            # predictions
+            preds_combined, model_preds, model_preds_combined, question_type_preds, mask = self.model(sample[0], sample[1], sample[2])
+
+            # question-type classification loss
+            question_type_loss = self.criterion(question_type_preds.float(), ans_type)
+
+            # component losses, computed in one call over the stacked component predictions
+            stacked_preds = torch.stack(preds_combined, 0).float()  # num_models x b x num_answers
+            comp_loss = self.criterion(stacked_preds, answers.unsqueeze(0).expand_as(stacked_preds))
+
+            # VQA loss with question-type awareness and prior integrating into interaction learning
+            # answers outside the predicted question type are weighted out of the loss
+            prior_weighting_loss = F.binary_cross_entropy_with_logits(model_preds.float(), answers, weight=mask, reduction='sum')
+
+            awareness_weighting_loss = self.criterion(model_preds_combined.float(), answers)
+
+            # prior_awareness_vqa_loss = awareness_weighting_loss + self.args.g_ratio * prior_weighting_loss
+
+            # VQA multi-task loss, every term is divided by batch size once at the end
+            inv_batch_size = 1.0 / answers.size(0)
+            loss = inv_batch_size * (comp_loss + awareness_weighting_loss + self.args.g_ratio * prior_weighting_loss + self.args.q_ratio * question_type_loss)
+
+            final_preds = model_preds_combined
+            batch_question_type_score = compute_score_with_logits(question_type_preds, ans_type).sum()
+        batch_score = compute_score_with_logits(final_preds, sample[3].data).sum()
+        return loss, batch_score, batch_question_type_score
+
     def _backward(self, loss):
         oom = 0
         if loss is not None:
             try:
                 # backward pass
-                loss.backward()
+                self.scaler.scale(loss).backward()
             except RuntimeError as e:
                 if 'out of memory' in str(e):
                     print('| WARNING: ran out of memory, skipping batch')
@@ -183,52 +200,31 @@ class Trainer(object):
         return oom
 
     def _all_reduce_and_rescale(self, grad_denom):
-        # flatten grads into a single buffer and all-reduce
-        flat_grads = self._flat_grads = self._get_flat_grads(self._flat_grads)
-
-        # rescale and clip gradients
-        flat_grads.div_(grad_denom)
-        grad_norm = utils.clip_grad_norm_(flat_grads, self.args.clip_norm)
-
-        # copy grads back into model parameters
-        self._set_flat_grads(flat_grads)
+        # unscale grads so that clipping sees their true norm
+        self.scaler.unscale_(self.optimizer)
+
+        # rescale and clip gradients in place with multi-tensor kernels
+        params = [p for p in self._trainable_params if p.grad is not None]
+        grads = [p.grad for p in params]
+        if len(grads) > 0:
+            torch._foreach_div_(grads, float(grad_denom))
+        if self.args.clip_norm > 0:
+            grad_norm = torch.nn.utils.clip_grad_norm_(params, self.args.clip_norm, foreach=True)
+        elif len(grads) > 0:
+            # clipping is disabled, only measure the norm without touching the grads
+            grad_norm = torch.linalg.vector_norm(torch.stack(torch._foreach_norm(grads)))
+        else:
+            grad_norm = torch.zeros((), device=self.args.device)
 
+        # overflowed grads make the scaler skip this step, so their norm is not reported
+        if self.scaler.is_enabled() and not torch.isfinite(grad_norm):
+            return None
         return grad_norm
 
-    def _get_grads(self):
-        grads = []
-        for name, p in self.model.named_parameters():
-            if not p.requires_grad:
-                continue
-            if p.grad is None:
-                raise RuntimeError('Model parameter did not receive gradient: ' + name + '. '
-                                                                                         'Use the param in the forward pass or set requires_grad=False')
-            grads.append(p.grad.data)
-        return grads
-
-    def _get_flat_grads(self, out=None):
-        grads = self._get_grads()
-        if out is None:
-            grads_size = sum(g.numel() for g in grads)
-            out = grads[0].new(grads_size).zero_()
-        offset = 0
-        for g in grads:
-            numel = g.numel()
-            out[offset:offset+numel].copy_(g.view(-1))
-            offset += numel
-        return out[:offset]
-
-    def _set_flat_grads(self, new_grads):
-        grads = self._get_grads()
-        offset = 0
-        for g in grads:
-            numel = g.numel()
-            g.copy_(new_grads[offset:offset+numel].view_as(g))
-            offset += numel
-
     def _opt(self):
-        # take an optimization step
-        self.optimizer.step()
+        # take an optimization step, skipped by the scaler if grads overflowed
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
         self.zero_grad()
         self._num_updates += 1
 
@@ -236,7 +232,7 @@ class Trainer(object):
         # self.lr_scheduler.step_update(self._num_updates)
 
     def zero_grad(self):
-        self.optimizer.zero_grad()
+        self.optimizer.zero_grad(set_to_none=True)
 
     def clear_buffered_stats(self):
         self._buffered_stats.clear()
@@ -257,9 +253,6 @@ class Trainer(object):
         self.clear_buffered_stats()
 
 def compute_score_with_logits(logits, labels):
-    logits = torch.max(logits, 1)[1].data  # argmax
-    one_hots = torch.zeros(*labels.size()).to(logits.device)
-    one_hots.scatter_(1, logits.view(-1, 1), 1)
-    scores = (one_hots * labels)
-    return scores
+    idx = logits.detach().argmax(1, keepdim=True)  # argmax
+    return labels.gather(1, idx).squeeze(1)  # score of the predicted answer per sample
 
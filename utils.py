@@ -7,7 +7,7 @@ from __future__ import print_function
 import errno
 import os
 import re
-import collections
+import collections.abc
 import numpy as np
 import operator
 import functools
@@ -15,7 +15,6 @@ from PIL import Image
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch._six import string_classes
 from torch.utils.data.dataloader import default_collate
 import math
 import time
@@ -95,13 +94,15 @@ def print_model(model, logger):
     if logger:
         logger.write('nParams=\t'+str(nParams))
 
-def save_model(path, model, epoch, optimizer=None):
+def save_model(path, model, epoch, optimizer=None, scaler=None):
     model_dict = {
             'epoch': epoch,
             'model_state': model.state_dict()
         }
     if optimizer is not None:
         model_dict['optimizer_state'] = optimizer.state_dict()
+    if scaler is not None and scaler.is_enabled():
+        model_dict['scaler_state'] = scaler.state_dict()
 
     torch.save(model_dict, path)
 
@@ -122,6 +123,8 @@ def trim_collate(batch):
     elem_type = type(batch[0])
     if torch.is_tensor(batch[0]):
         out = None
+        if batch[0].is_cuda:  # features preloaded on device are stacked directly on device
+            _use_shared_memory = False
         if 1 < batch[0].dim(): # image features
             max_num_boxes = max([x.size(0) for x in batch])
             if _use_shared_memory:
@@ -156,11 +159,11 @@ def trim_collate(batch):
         return torch.LongTensor(batch)
     elif isinstance(batch[0], float):
         return torch.DoubleTensor(batch)
-    elif isinstance(batch[0], string_classes):
+    elif isinstance(batch[0], str):
         return batch
-    elif isinstance(batch[0], collections.Mapping):
+    elif isinstance(batch[0], collections.abc.Mapping):
         return {key: default_collate([d[key] for d in batch]) for key in batch[0]}
-    elif isinstance(batch[0], collections.Sequence):
+    elif isinstance(batch[0], collections.abc.Sequence):
         transposed = zip(*batch)
         return [trim_collate(samples) for samples in transposed]
 
@@ -234,6 +237,40 @@ def move_to_cuda(sample):
 
     return _move_to_cuda(sample)
 
+class DataPrefetcher(object):
+    """Iterate over a dataloader while copying the next batch to device on a side CUDA stream,
+    so that the host-to-device transfer overlaps with the computation of the current batch."""
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        batch = self._preload(loader_iter)
+        while batch is not None:
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                for tensor in batch:
+                    tensor.record_stream(current_stream)
+            next_batch = self._preload(loader_iter)
+            yield batch
+            batch = next_batch
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        if self.stream is None:
+            return [tensor.to(self.device) for tensor in batch]
+        with torch.cuda.stream(self.stream):
+            return [tensor.to(self.device, non_blocking=True) for tensor in batch]
+
 def item(tensor):
     if hasattr(tensor, 'item'):
         return tensor.item()
@@ -241,13 +278,6 @@ def item(tensor):
         return tensor[0]
     return tensor
 
-def clip_grad_norm_(tensor, max_norm):
-    grad_norm = item(torch.norm(tensor))
-    if grad_norm > max_norm > 0:
-        clip_coef = max_norm / (grad_norm + 1e-6)
-        tensor.mul_(clip_coef)
-    return grad_norm
-
 def to_sparse(x):
     """ converts dense tensor x to sparse format """
     x_typename = torch.typename(x).split('.')[-1]